@@ -485,6 +485,7 @@ class BuildFileProcessor(object):
                  enable_build_file_sandboxing, implicit_includes=[], extra_funcs=[], configs={},
                  ignore_paths=[]):
         self._cache = {}
+        self._builtins = {}
         self._build_env_stack = []
         self._sync_cookie_state = SyncCookieState()
 
@@ -523,7 +524,12 @@ class BuildFileProcessor(object):
 
         for key in keys:
             if not key.startswith('_') and key not in hidden:
-                dst[key] = mod.__dict__[key]
+                value = mod.__dict__[key]
+                # Don't let a processor-installed build function clobber an
+                # override of it in the destination.
+                if key in self._builtins and value is self._builtins[key]:
+                    continue
+                dst[key] = value
 
     def _update_functions(self, build_env):
         """
@@ -533,11 +539,18 @@ class BuildFileProcessor(object):
         for function in self._functions.itervalues():
             function.build_env = build_env
 
-    def install_builtins(self, namespace):
+    def install_builtins(self, namespace=None):
         """
         Installs the build functions, by their name, into the given namespace.
+
+        If no namespace is given, the functions are installed into a fresh
+        dict, which is then added to the globals of every file this processor
+        executes instead of the interpreter-wide builtins.
         """
 
+        if namespace is None:
+            namespace = self._builtins = {}
+
         for name, function in self._functions.iteritems():
             namespace[name] = function.invoke
 
@@ -670,7 +683,7 @@ class BuildFileProcessor(object):
         self._push_build_env(build_env)
 
         # The globals dict that this file will be executed under.
-        default_globals = {}
+        default_globals = dict(self._builtins)
 
         # Install the 'include_defs' function into our global object.
         default_globals['include_defs'] = functools.partial(
@@ -1,15 +1,44 @@
 import __builtin__
+import errno
+import functools
 import os
 import unittest
-import shutil
 import tempfile
 import sys
-import StringIO
 
 from .buck import BuildFileProcessor, DiagnosticMessageAndLevel, add_rule
 
 
-def foo_rule(name, srcs=[], visibility=[], build_env=None):
+# Joined and encoded `ProjectFile` contents, keyed by the type and value of
+# the contents passed in.
+_CONTENT_CACHE = {}
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+
+
+def _fast_rmtree(path):
+    """
+    Remove the tree at the given path, bottom up.
+
+    Unlike `shutil.rmtree`, this doesn't stat every entry to decide how to
+    remove it; it just tries unlinking first and falls back to `os.rmdir`.
+    """
+
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames + dirnames:
+            entry = os.path.join(dirpath, name)
+            try:
+                os.unlink(entry)
+            except OSError as e:
+                # Unlinking a directory fails with EISDIR on Linux and EPERM
+                # elsewhere; anything else is a real error.
+                if e.errno not in (errno.EISDIR, errno.EPERM):
+                    raise
+                os.rmdir(entry)
+    os.rmdir(path)
+
+
+def foo_rule(name, srcs=(), visibility=(), build_env=None):
     add_rule({
         'buck.type': 'foo',
         'name': name,
@@ -18,9 +47,33 @@ def foo_rule(name, srcs=[], visibility=[], build_env=None):
     }, build_env)
 
 
+class FakeWatchmanError(Exception):
+    pass
+
+
+class FakeWatchmanClient(object):
+    """
+    A watchman client whose queries either fail (`'fail'`) or succeed with a
+    warning (`'warn'`).
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.query_invoked = False
+
+    def query(self, *args):
+        self.query_invoked = True
+        if self.mode == 'fail':
+            raise FakeWatchmanError("whoops")
+        return {'warning': 'This is a warning', 'files': ['Foo.java']}
+
+    def close(self):
+        pass
+
+
 def extract_from_results(name, results):
     for result in results:
-        if result.keys() == [name]:
+        if len(result) == 1 and name in result:
             return result[name]
     raise ValueError(str(results))
 
@@ -38,37 +91,107 @@ class ProjectFile(object):
     def __init__(self, path, contents):
         self.path = path
         self.name = '//{0}'.format(path)
+        self._abspath = {}
         if isinstance(contents, (tuple, list)):
-            contents = os.linesep.join(contents) + os.linesep
-        self.contents = contents
+            contents = tuple(contents)
+        # `str` and `unicode` contents compare equal, so keep them apart, down
+        # to the individual lines, which decide the type of the joined text.
+        if isinstance(contents, tuple):
+            key = (tuple, tuple(type(line) for line in contents), contents)
+        else:
+            key = (type(contents), contents)
+        cached = _CONTENT_CACHE.get(key)
+        if cached is None:
+            text = contents
+            if isinstance(text, tuple):
+                text = os.linesep.join(text) + os.linesep
+            data = text
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            cached = _CONTENT_CACHE[key] = (text, data)
+        self.contents, self.contents_bytes = cached
+
+    def abspath(self, root):
+        """
+        Return the absolute path of this file under the given project root.
+        """
+
+        path = self._abspath.get(root)
+        if path is None:
+            path = self._abspath[root] = root + os.sep + self.path
+        return path
+
+
+# An include def shared by tests which just need it to define `FOO`.
+INC_FOO = ProjectFile(path='inc_def1', contents=('FOO = 1',))
 
 
 class BuckTest(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Share a single scratch root (on tmpfs where available) between all
+        # tests, so each test only pays for its own files.
+        cls._root = tempfile.mkdtemp(
+            prefix='buck_%d_' % os.getpid(),
+            dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+    @classmethod
+    def tearDownClass(cls):
+        _fast_rmtree(cls._root)
+
     def setUp(self):
-        self.project_root = tempfile.mkdtemp()
+        self.project_root = os.path.join(self._root, self.id())
+        os.mkdir(self.project_root)
+        self._written = []
         self.allow_empty_globs = False
         self.build_file_name = 'BUCK'
         self.watchman_client = None
         self.watchman_error = None
         self.enable_build_file_sandboxing = False
 
+        # Tests may still tweak the remaining arguments after setUp, so only
+        # bind the ones that are fixed for the whole test.
+        self._make_processor = functools.partial(
+            BuildFileProcessor,
+            self.project_root,
+            self.project_root,  # watchman_watch_root
+            None)               # watchman_project_prefix
+
     def tearDown(self):
-        shutil.rmtree(self.project_root, True)
+        for path in self._written:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                # The test may have already removed it itself.
+                if e.errno != errno.ENOENT:
+                    raise
+        try:
+            os.rmdir(self.project_root)
+        except OSError:
+            # Something other than `write_files` left files behind.
+            _fast_rmtree(self.project_root)
 
     def write_file(self, pfile):
-        with open(os.path.join(self.project_root, pfile.path), 'w') as f:
-            f.write(pfile.contents)
+        self.write_files(pfile)
 
     def write_files(self, *pfiles):
-        for pfile in pfiles:
-            self.write_file(pfile)
+        project_root = self.project_root
+        payloads = [(p.abspath(project_root), p) for p in pfiles]
+
+        _open, _write, _close = os.open, os.write, os.close
+        written = self._written
+        for path, pfile in payloads:
+            fd = _open(path, _WRITE_FLAGS, 0o644)
+            try:
+                _write(fd, pfile.contents_bytes)
+            finally:
+                _close(fd)
+            if path not in written:
+                written.append(path)
 
     def create_build_file_processor(self, *includes, **kwargs):
-        return BuildFileProcessor(
-            self.project_root,
-            self.project_root,  # watchman_watch_root
-            None,               # watchman_project_prefix
+        return self._make_processor(
             self.build_file_name,
             self.allow_empty_globs,
             False,              # ignore_buck_autodeps_files
@@ -78,6 +201,27 @@ class BuckTest(unittest.TestCase):
             includes,
             **kwargs)
 
+    def install_interpreter_builtins(self, build_file_processor):
+        """
+        Install the build functions into `__builtin__`, as `main` does, and
+        restore whatever they replaced once the test finishes.
+        """
+
+        namespace = __builtin__.__dict__
+        names = {}
+        build_file_processor.install_builtins(names)
+        saved = dict((name, namespace[name]) for name in names if name in namespace)
+
+        def restore():
+            for name in names:
+                if name in saved:
+                    namespace[name] = saved[name]
+                else:
+                    namespace.pop(name, None)
+
+        self.addCleanup(restore)
+        build_file_processor.install_builtins(namespace)
+
     def test_sibling_includes_use_separate_globals(self):
         """
         Test that consecutive includes can't see each others globals.
@@ -90,16 +234,15 @@ class BuckTest(unittest.TestCase):
 
         # Setup the includes defs.  The first one defines a variable that the
         # second one (incorrectly) implicitly references.
-        include_def1 = ProjectFile(path='inc_def1', contents=('FOO = 1',))
         include_def2 = ProjectFile(path='inc_def2', contents=('BAR = FOO',))
-        self.write_files(include_def1, include_def2)
+        self.write_files(INC_FOO, include_def2)
 
         # Construct a processor using the above as default includes, and verify
         # that the second one can't use the first's globals.
         build_file = ProjectFile(path='BUCK', contents='')
         self.write_file(build_file)
         build_file_processor = self.create_build_file_processor(
-            include_def1.name,
+            INC_FOO.name,
             include_def2.name)
         self.assertRaises(
             NameError,
@@ -112,7 +255,7 @@ class BuckTest(unittest.TestCase):
         build_file = ProjectFile(
             path='BUCK',
             contents=(
-                'include_defs({0!r})'.format(include_def1.name),
+                'include_defs({0!r})'.format(INC_FOO.name),
                 'include_defs({0!r})'.format(include_def2.name),
             ))
         self.write_file(build_file)
@@ -133,15 +276,14 @@ class BuckTest(unittest.TestCase):
 
         # Setup the includes defs.  The first one defines a variable that the
         # second one references after a local 'include_defs' call.
-        include_def1 = ProjectFile(path='inc_def1', contents=('FOO = 1',))
         include_def2 = ProjectFile(
             path='inc_def2',
             contents=(
                 'def test():',
-                '    include_defs({0!r})'.format(include_def1.name),
+                '    include_defs({0!r})'.format(INC_FOO.name),
                 '    FOO',
             ))
-        self.write_files(include_def1, include_def2)
+        self.write_files(INC_FOO, include_def2)
 
         # Construct a processor using the above as default includes, and verify
         # that the function 'test' can use 'FOO' after including the first
@@ -149,7 +291,7 @@ class BuckTest(unittest.TestCase):
         build_file = ProjectFile(path='BUCK', contents=('test()',))
         self.write_file(build_file)
         build_file_processor = self.create_build_file_processor(
-            include_def1.name,
+            INC_FOO.name,
             include_def2.name)
         build_file_processor.process(build_file.path, set())
 
@@ -160,7 +302,7 @@ class BuckTest(unittest.TestCase):
         build_file = ProjectFile(
             path='BUCK',
             contents=(
-                'include_defs({0!r})'.format(include_def1.name),
+                'include_defs({0!r})'.format(INC_FOO.name),
                 'include_defs({0!r})'.format(include_def2.name),
                 'test()',
             ))
@@ -257,12 +399,24 @@ class BuckTest(unittest.TestCase):
             build_file_processor.process,
             build_file.path, set())
 
-    def test_do_not_override_overridden_builtins(self):
+    def test_none_valued_include_globals_are_imported(self):
         """
-        We want to ensure that if you override something like java_binary, and then use
-        include_defs to get another file, you don't end up clobbering your override.
+        Verify that include globals set to `None` still get imported.
         """
 
+        include_def = ProjectFile(path='inc_def1', contents=('FOO = None',))
+        build_file = ProjectFile(
+            path='BUCK',
+            contents=(
+                'include_defs({0!r})'.format(include_def.name),
+                'assert FOO is None',
+            ))
+        self.write_files(include_def, build_file)
+
+        build_file_processor = self.create_build_file_processor()
+        build_file_processor.process(build_file.path, set())
+
+    def check_overridden_builtins_are_kept(self, install_builtins):
         # Override java_library and have it automatically add a dep
         build_defs = ProjectFile(
             path='BUILD_DEFS',
@@ -283,28 +437,31 @@ class BuckTest(unittest.TestCase):
         self.write_files(build_defs, other_defs, build_file)
 
         build_file_processor = self.create_build_file_processor(build_defs.name)
-        build_file_processor.install_builtins(__builtin__.__dict__)
+        install_builtins(build_file_processor)
         self.assertRaises(
             ValueError,
             build_file_processor.process,
             build_file.path, set())
 
-    def test_watchman_glob_failure_falls_back_to_regular_glob_and_adds_diagnostic(self):
-        class FakeWatchmanError(Exception):
-            pass
+    def test_do_not_override_overridden_builtins(self):
+        """
+        We want to ensure that if you override something like java_binary, and then use
+        include_defs to get another file, you don't end up clobbering your override.
+        """
 
-        class FakeWatchmanClient:
-            def FakeWatchmanClient(self):
-                self.query_invoked = False
+        self.check_overridden_builtins_are_kept(self.install_interpreter_builtins)
 
-            def query(self, *args):
-                self.query_invoked = True
-                raise FakeWatchmanError("whoops")
+    def test_do_not_override_overridden_private_builtins(self):
+        """
+        Same as above, but with the build functions installed into the
+        processor's own namespace rather than the interpreter builtins.
+        """
 
-            def close(self):
-                pass
+        self.check_overridden_builtins_are_kept(
+            lambda processor: processor.install_builtins())
 
-        self.watchman_client = FakeWatchmanClient()
+    def test_watchman_glob_failure_falls_back_to_regular_glob_and_adds_diagnostic(self):
+        self.watchman_client = FakeWatchmanClient('fail')
         self.watchman_error = FakeWatchmanError
 
         build_file = ProjectFile(
@@ -318,7 +475,7 @@ class BuckTest(unittest.TestCase):
         java_file = ProjectFile(path='Foo.java', contents=())
         self.write_files(build_file, java_file)
         build_file_processor = self.create_build_file_processor(extra_funcs=[foo_rule])
-        build_file_processor.install_builtins(__builtin__.__dict__)
+        build_file_processor.install_builtins()
         diagnostics = set()
         rules = build_file_processor.process(build_file.path, diagnostics)
         self.assertTrue(self.watchman_client.query_invoked)
@@ -330,14 +487,7 @@ class BuckTest(unittest.TestCase):
             diagnostics)
 
     def test_watchman_glob_warning_adds_diagnostic(self):
-        class FakeWatchmanClient:
-            def query(self, *args):
-                return {'warning': 'This is a warning', 'files': ['Foo.java']}
-
-            def close(self):
-                pass
-
-        self.watchman_client = FakeWatchmanClient()
+        self.watchman_client = FakeWatchmanClient('warn')
 
         build_file = ProjectFile(
             path='BUCK',
@@ -350,7 +500,7 @@ class BuckTest(unittest.TestCase):
         java_file = ProjectFile(path='Foo.java', contents=())
         self.write_files(build_file, java_file)
         build_file_processor = self.create_build_file_processor(extra_funcs=[foo_rule])
-        build_file_processor.install_builtins(__builtin__.__dict__)
+        build_file_processor.install_builtins()
         diagnostics = set()
         rules = build_file_processor.process(build_file.path, diagnostics)
         self.assertEqual(['Foo.java'], rules[0]['srcs'])
@@ -411,16 +561,28 @@ class BuckTest(unittest.TestCase):
         py_file = ProjectFile(path='foo.py', contents=())
         self.write_files(build_file, py_file)
         build_file_processor = self.create_build_file_processor()
-        build_file_processor.install_builtins(__builtin__.__dict__)
+        build_file_processor.install_builtins()
         diagnostics = set()
 
-        try:
-            out = StringIO.StringIO()
+        # Capture the warnings into a temporary file, both through
+        # `sys.stdout` and at the file descriptor level.  Unlike a pipe, this
+        # can't block however much the sandbox prints.
+        build_file_path = os.path.join(self.project_root, build_file.path)
+        with tempfile.TemporaryFile() as out:
+            sys.stdout.flush()
+            saved = os.dup(1)
+            saved_stdout = sys.stdout
+            os.dup2(out.fileno(), 1)
             sys.stdout = out
-            build_file_path = os.path.join(self.project_root, build_file.path)
-            build_file_processor.process(build_file.path, diagnostics)
-            self.assertEqual(
-                sys.stdout.getvalue().strip(),
-                'Importing module ssl in file %s is discouraged' % build_file_path)
-        finally:
-            sys.stdout = sys.__stdout__
+            try:
+                build_file_processor.process(build_file.path, diagnostics)
+            finally:
+                out.flush()
+                sys.stdout = saved_stdout
+                os.dup2(saved, 1)
+                os.close(saved)
+            out.seek(0)
+            captured = out.read()
+        self.assertEqual(
+            captured.decode('utf-8').strip(),
+            'Importing module ssl in file %s is discouraged' % build_file_path)